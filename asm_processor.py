@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
-import argparse
-import tempfile
+import functools
 import struct
+import mmap
 import sys
 import re
 import os
 from collections import namedtuple
-from io import StringIO
+from io import BytesIO, StringIO, TextIOWrapper
+from types import SimpleNamespace
 
 MAX_FN_SIZE = 100
 SLOW_CHECKS = False
+CACHE_MAX_ENTRIES = 10000
 
 EI_NIDENT     = 16
 EI_CLASS      = 4
@@ -64,6 +66,9 @@ SHT_MIPS_DEBUG    = 0x70000005
 SHT_MIPS_REGINFO  = 0x70000006
 SHT_MIPS_OPTIONS  = 0x7000000d
 
+# Section types removed by --drop-mdebug-gptab
+MDEBUG_GPTAB_TYPES = frozenset([SHT_MIPS_DEBUG, SHT_MIPS_GPTAB])
+
 SHF_WRITE            = 0x1
 SHF_ALLOC            = 0x2
 SHF_EXECINSTR        = 0x4
@@ -95,12 +100,33 @@ class ElfFormat:
     def __init__(self, is_big_endian):
         self.is_big_endian = is_big_endian
         self.struct_char = ">" if is_big_endian else "<"
+        self.structs = {}
+
+    def get_struct(self, fmt):
+        ret = self.structs.get(fmt)
+        if ret is None:
+            ret = self.structs[fmt] = struct.Struct(self.struct_char + fmt)
+        return ret
 
     def pack(self, fmt, *args):
-        return struct.pack(self.struct_char + fmt, *args)
+        return self.get_struct(fmt).pack(*args)
 
     def unpack(self, fmt, data):
-        return struct.unpack(self.struct_char + fmt, data)
+        return self.get_struct(fmt).unpack(data)
+
+    def unpack_from(self, fmt, data, offset):
+        return self.get_struct(fmt).unpack_from(data, offset)
+
+    def iter_unpack(self, fmt, data):
+        return self.get_struct(fmt).iter_unpack(data)
+
+    def pack_into(self, fmt, buffer, offset, *args):
+        self.get_struct(fmt).pack_into(buffer, offset, *args)
+
+
+# Shared between ELF files, so that their Struct caches are too. Indexed by
+# whether the format is big-endian.
+ELF_FORMATS = {True: ElfFormat(is_big_endian=True), False: ElfFormat(is_big_endian=False)}
 
 
 class ElfHeader:
@@ -126,7 +152,7 @@ class ElfHeader:
     def __init__(self, data):
         self.e_ident = data[:EI_NIDENT]
         assert self.e_ident[EI_CLASS] == 1 # 32-bit
-        self.fmt = ElfFormat(is_big_endian=(self.e_ident[EI_DATA] == 2))
+        self.fmt = ELF_FORMATS[self.e_ident[EI_DATA] == 2]
         self.e_type, self.e_machine, self.e_version, self.e_entry, self.e_phoff, self.e_shoff, self.e_flags, self.e_ehsize, self.e_phentsize, self.e_phnum, self.e_shentsize, self.e_shnum, self.e_shstrndx = self.fmt.unpack('HHIIIIIHHHHHH', data[EI_NIDENT:])
         assert self.e_type == 1 # relocatable
         assert self.e_machine == 8 # MIPS I Architecture
@@ -153,9 +179,15 @@ class Symbol:
     } Elf32_Sym;
     """
 
-    def __init__(self, fmt, data, strtab, name=None):
+    # Object files can have many symbols and relocations, so skip the
+    # per-instance __dict__. replace_by and new_index are only set while
+    # fixing up the symbol table.
+    __slots__ = ('fmt', 'st_name', 'st_value', 'st_size', 'st_other', 'st_shndx',
+                 'bind', 'type', 'name', 'visibility', 'replace_by', 'new_index')
+
+    def __init__(self, fmt, fields, strtab, name=None):
         self.fmt = fmt
-        self.st_name, self.st_value, self.st_size, st_info, self.st_other, self.st_shndx = fmt.unpack('IIIBBH', data)
+        self.st_name, self.st_value, self.st_size, st_info, self.st_other, self.st_shndx = fields
         assert self.st_shndx != SHN_XINDEX, "too many sections (SHN_XINDEX not supported)"
         self.bind = st_info >> 4
         self.type = st_info & 15
@@ -164,31 +196,40 @@ class Symbol:
 
     @staticmethod
     def from_parts(fmt, st_name, st_value, st_size, st_info, st_other, st_shndx, strtab, name):
-        header = fmt.pack('IIIBBH', st_name, st_value, st_size, st_info, st_other, st_shndx)
-        return Symbol(fmt, header, strtab, name)
+        return Symbol(fmt, (st_name, st_value, st_size, st_info, st_other, st_shndx), strtab, name)
 
-    def to_bin(self):
+    def pack_into(self, buffer, offset):
         st_info = (self.bind << 4) | self.type
-        return self.fmt.pack('IIIBBH', self.st_name, self.st_value, self.st_size, st_info, self.st_other, self.st_shndx)
+        self.fmt.pack_into('IIIBBH', buffer, offset, self.st_name, self.st_value, self.st_size, st_info, self.st_other, self.st_shndx)
 
 
 class Relocation:
-    def __init__(self, fmt, data, sh_type):
+    __slots__ = ('fmt', 'sh_type', 'r_offset', 'r_info', 'r_addend', 'sym_index', 'rel_type')
+
+    def __init__(self, fmt, fields, sh_type):
         self.fmt = fmt
         self.sh_type = sh_type
         if sh_type == SHT_REL:
-            self.r_offset, self.r_info = fmt.unpack('II', data)
+            self.r_offset, self.r_info = fields
         else:
-            self.r_offset, self.r_info, self.r_addend = fmt.unpack('III', data)
+            self.r_offset, self.r_info, self.r_addend = fields
         self.sym_index = self.r_info >> 8
         self.rel_type = self.r_info & 0xff
 
-    def to_bin(self):
+    def pack_into(self, buffer, offset):
         self.r_info = (self.sym_index << 8) | self.rel_type
         if self.sh_type == SHT_REL:
-            return self.fmt.pack('II', self.r_offset, self.r_info)
+            self.fmt.pack_into('II', buffer, offset, self.r_offset, self.r_info)
         else:
-            return self.fmt.pack('III', self.r_offset, self.r_info, self.r_addend)
+            self.fmt.pack_into('III', buffer, offset, self.r_offset, self.r_info, self.r_addend)
+
+
+def pack_entries(entries, entsize):
+    # Serialize symbols or relocations into a single preallocated buffer.
+    buffer = bytearray(entsize * len(entries))
+    for i, entry in enumerate(entries):
+        entry.pack_into(buffer, i * entsize)
+    return bytes(buffer)
 
 
 class Section:
@@ -207,23 +248,28 @@ class Section:
     } Elf32_Shdr;
     """
 
-    def __init__(self, fmt, header, data, index):
+    def __init__(self, fmt, fields, data, index):
         self.fmt = fmt
-        self.sh_name, self.sh_type, self.sh_flags, self.sh_addr, self.sh_offset, self.sh_size, self.sh_link, self.sh_info, self.sh_addralign, self.sh_entsize = fmt.unpack('IIIIIIIIII', header)
+        self.sh_name, self.sh_type, self.sh_flags, self.sh_addr, self.sh_offset, self.sh_size, self.sh_link, self.sh_info, self.sh_addralign, self.sh_entsize = fields
         assert not self.sh_flags & SHF_LINK_ORDER
         if self.sh_entsize != 0:
             assert self.sh_size % self.sh_entsize == 0
         if self.sh_type == SHT_NOBITS:
             self.data = b''
+        elif self.sh_type == SHT_STRTAB:
+            # String tables get appended to, so make that cheap
+            self.data = bytearray(data[self.sh_offset:self.sh_offset + self.sh_size])
         else:
             self.data = data[self.sh_offset:self.sh_offset + self.sh_size]
         self.index = index
         self.relocated_by = []
+        self._relocations = None
+        self._str_offsets = None
 
     @staticmethod
     def from_parts(fmt, sh_name, sh_type, sh_flags, sh_link, sh_info, sh_addralign, sh_entsize, data, index):
-        header = fmt.pack('IIIIIIIIII', sh_name, sh_type, sh_flags, 0, 0, len(data), sh_link, sh_info, sh_addralign, sh_entsize)
-        return Section(fmt, header, data, index)
+        fields = (sh_name, sh_type, sh_flags, 0, 0, len(data), sh_link, sh_info, sh_addralign, sh_entsize)
+        return Section(fmt, fields, data, index)
 
     def lookup_str(self, index):
         assert self.sh_type == SHT_STRTAB
@@ -233,8 +279,20 @@ class Section:
 
     def add_str(self, string):
         assert self.sh_type == SHT_STRTAB
-        ret = len(self.data)
-        self.data += string.encode('latin1') + b'\0'
+        if self._str_offsets is None:
+            # Offsets of the strings already in the table, for reuse. The
+            # table is only ever appended to, so entries never go stale.
+            self._str_offsets = {}
+            offset = 0
+            for s in self.data.decode('latin1').split('\0')[:-1]:
+                self._str_offsets.setdefault(s, offset)
+                offset += len(s) + 1
+        ret = self._str_offsets.get(string)
+        if ret is None:
+            ret = len(self.data)
+            self.data += string.encode('latin1')
+            self.data.append(0)
+            self._str_offsets[string] = ret
         return ret
 
     def is_rel(self):
@@ -251,14 +309,13 @@ class Section:
         elif self.is_rel():
             self.rel_target = sections[self.sh_info]
             self.rel_target.relocated_by.append(self)
-            self.init_relocs()
 
     def find_symbol(self, name):
         assert self.sh_type == SHT_SYMTAB
-        for s in self.symbol_entries:
-            if s.name == name:
-                return (s.st_shndx, s.st_value)
-        return None
+        s = self.symbols_by_name.get(name)
+        if s is None:
+            return None
+        return (s.st_shndx, s.st_value)
 
     def find_symbol_in_section(self, name, section):
         pos = self.find_symbol(name)
@@ -270,17 +327,34 @@ class Section:
         assert self.sh_type == SHT_SYMTAB
         assert self.sh_entsize == 16
         self.strtab = sections[self.sh_link]
-        entries = []
-        for i in range(0, self.sh_size, self.sh_entsize):
-            entries.append(Symbol(self.fmt, self.data[i:i+self.sh_entsize], self.strtab))
+        # Split up the string table once, rather than searching it for every
+        # symbol. Names that point into the middle of a string (suffix sharing)
+        # are looked up the slow way.
+        names = {}
+        offset = 0
+        for name in self.strtab.data.decode('latin1').split('\0'):
+            names[offset] = name
+            offset += len(name) + 1
+        entries = [Symbol(self.fmt, fields, self.strtab, names.get(fields[0])) for fields in self.fmt.iter_unpack('IIIBBH', self.data)]
         self.symbol_entries = entries
-
-    def init_relocs(self):
-        assert self.is_rel()
-        entries = []
-        for i in range(0, self.sh_size, self.sh_entsize):
-            entries.append(Relocation(self.fmt, self.data[i:i+self.sh_entsize], self.sh_type))
-        self.relocations = entries
+        # For lookups by name, favoring the first symbol with a given name
+        self.symbols_by_name = {}
+        for s in entries:
+            self.symbols_by_name.setdefault(s.name, s)
+
+    # Relocations are parsed on first use, since some relocation sections
+    # (e.g. for .pdr) are never looked at.
+    @property
+    def relocations(self):
+        if self._relocations is None:
+            assert self.is_rel()
+            fmt = 'II' if self.sh_type == SHT_REL else 'III'
+            self._relocations = [Relocation(self.fmt, fields, self.sh_type) for fields in self.fmt.iter_unpack(fmt, self.data)]
+        return self._relocations
+
+    @relocations.setter
+    def relocations(self, relocations):
+        self._relocations = relocations
 
     def local_symbols(self):
         assert self.sh_type == SHT_SYMTAB
@@ -292,7 +366,6 @@ class Section:
 
     def relocate_mdebug(self, original_offset):
         assert self.sh_type == SHT_MIPS_DEBUG
-        new_data = bytearray(self.data)
         shift_by = self.sh_offset - original_offset
 
         # Update the file-relative offsets in the Symbolic HDRR
@@ -302,7 +375,7 @@ class Section:
             hdrr_cbOptOffset, hdrr_iauxMax, hdrr_cbAuxOffset, hdrr_issMax, \
             hdrr_cbSsOffset, hdrr_issExtMax, hdrr_cbSsExtOffset, hdrr_ifdMax, \
             hdrr_cbFdOffset, hdrr_crfd, hdrr_cbRfdOffset, hdrr_iextMax, \
-            hdrr_cbExtOffset = self.fmt.unpack("HHIIIIIIIIIIIIIIIIIIIIIII", self.data[0:0x60])
+            hdrr_cbExtOffset = self.fmt.unpack_from("HHIIIIIIIIIIIIIIIIIIIIIII", self.data, 0)
 
         assert hdrr_magic == 0x7009, "Invalid magic value for .mdebug symbolic header"
 
@@ -318,7 +391,8 @@ class Section:
         if hdrr_crfd: hdrr_cbRfdOffset += shift_by
         if hdrr_iextMax: hdrr_cbExtOffset += shift_by
 
-        new_data[0:0x60] = self.fmt.pack("HHIIIIIIIIIIIIIIIIIIIIIII", hdrr_magic, hdrr_vstamp, hdrr_ilineMax, hdrr_cbLine, \
+        # Only the header changes, so splice it onto the rest of the data
+        new_header = self.fmt.pack("HHIIIIIIIIIIIIIIIIIIIIIII", hdrr_magic, hdrr_vstamp, hdrr_ilineMax, hdrr_cbLine, \
             hdrr_cbLineOffset, hdrr_idnMax, hdrr_cbDnOffset, hdrr_ipdMax, \
             hdrr_cbPdOffset, hdrr_isymMax, hdrr_cbSymOffset, hdrr_ioptMax, \
             hdrr_cbOptOffset, hdrr_iauxMax, hdrr_cbAuxOffset, hdrr_issMax, \
@@ -326,7 +400,7 @@ class Section:
             hdrr_cbFdOffset, hdrr_crfd, hdrr_cbRfdOffset, hdrr_iextMax, \
             hdrr_cbExtOffset)
 
-        self.data = bytes(new_data)
+        self.data = new_header + self.data[0x60:]
 
 class ElfFile:
     def __init__(self, data):
@@ -336,14 +410,15 @@ class ElfFile:
         self.elf_header = ElfHeader(data[0:52])
         self.fmt = self.elf_header.fmt
 
+        # Parse all section headers in one go. If there are too many sections
+        # for e_shnum, the count is stored in the null section's sh_size.
         offset, size = self.elf_header.e_shoff, self.elf_header.e_shentsize
-        null_section = Section(self.fmt, data[offset:offset + size], data, 0)
-        num_sections = self.elf_header.e_shnum or null_section.sh_size
-
-        self.sections = [null_section]
-        for i in range(1, num_sections):
-            ind = offset + i * size
-            self.sections.append(Section(self.fmt, data[ind:ind + size], data, i))
+        assert size == 40
+        num_sections = self.elf_header.e_shnum or self.fmt.unpack_from('IIIIIIIIII', data, offset)[5]
+        headers = memoryview(data)[offset:offset + num_sections * size]
+        assert len(headers) == num_sections * size
+        self.sections = [Section(self.fmt, fields, data, i)
+                for i, fields in enumerate(self.fmt.iter_unpack('IIIIIIIIII', headers))]
 
         symtab = None
         for s in self.sections:
@@ -354,15 +429,14 @@ class ElfFile:
         self.symtab = symtab
 
         shstr = self.sections[self.elf_header.e_shstrndx]
+        self.sections_by_name = {}
         for s in self.sections:
             s.name = shstr.lookup_str(s.sh_name)
             s.late_init(self.sections)
+            self.sections_by_name.setdefault(s.name, s)
 
     def find_section(self, name):
-        for s in self.sections:
-            if s.name == name:
-                return s
-        return None
+        return self.sections_by_name.get(name)
 
     def add_section(self, name, sh_type, sh_flags, sh_link, sh_info, sh_addralign, sh_entsize, data):
         shstr = self.sections[self.elf_header.e_shstrndx]
@@ -374,50 +448,50 @@ class ElfFile:
         self.sections.append(s)
         s.name = name
         s.late_init(self.sections)
+        self.sections_by_name.setdefault(name, s)
         return s
 
     def drop_mdebug_gptab(self):
         # We can only drop sections at the end, since otherwise section
         # references might be wrong. Luckily, these sections typically are.
-        while self.sections[-1].sh_type in [SHT_MIPS_DEBUG, SHT_MIPS_GPTAB]:
-            self.sections.pop()
+        while self.sections[-1].sh_type in MDEBUG_GPTAB_TYPES:
+            s = self.sections.pop()
+            if self.sections_by_name.get(s.name) is s:
+                del self.sections_by_name[s.name]
 
     def write(self, filename):
-        outfile = open(filename, 'wb')
-        outidx = 0
-        def write_out(data):
-            nonlocal outidx
-            outfile.write(data)
-            outidx += len(data)
+        # Assemble the whole file in memory, and write it out in one go.
+        out = bytearray()
         def pad_out(align):
-            if align and outidx % align:
-                write_out(b'\0' * (align - outidx % align))
+            if align and len(out) % align:
+                out.extend(bytes(align - len(out) % align))
 
         self.elf_header.e_shnum = len(self.sections)
-        write_out(self.elf_header.to_bin())
+        out += self.elf_header.to_bin()
 
         for s in self.sections:
             if s.sh_type != SHT_NOBITS and s.sh_type != SHT_NULL:
                 pad_out(s.sh_addralign)
                 old_offset = s.sh_offset
-                s.sh_offset = outidx
+                s.sh_offset = len(out)
                 if s.sh_type == SHT_MIPS_DEBUG and s.sh_offset != old_offset:
                     # The .mdebug section has moved, relocate offsets
                     s.relocate_mdebug(old_offset)
-                write_out(s.data)
+                out += s.data
 
         pad_out(4)
-        self.elf_header.e_shoff = outidx
+        self.elf_header.e_shoff = len(out)
         for s in self.sections:
-            write_out(s.header_to_bin())
+            out += s.header_to_bin()
 
-        outfile.seek(0)
-        outfile.write(self.elf_header.to_bin())
-        outfile.close()
+        header = self.elf_header.to_bin()
+        out[0:len(header)] = header
+        with open(filename, 'wb') as outfile:
+            outfile.write(out)
 
 
-def is_temp_name(name):
-    return name.startswith('_asmpp_')
+# Prefix for the names of temporary symbols generated by asm-processor
+TEMP_NAME_PREFIX = '_asmpp_'
 
 
 # https://stackoverflow.com/a/241506
@@ -429,10 +503,35 @@ def re_comment_replacer(match):
         return s
 
 
+@functools.lru_cache(maxsize=None)
+def is_ascii_compatible(encoding):
+    # Whether ASCII text encodes to the same bytes, as with UTF-8, EUC-JP or
+    # Shift JIS (but not e.g. UTF-16)
+    ascii_bytes = bytes(range(128))
+    return ascii_bytes.decode('ascii').encode(encoding) == ascii_bytes
+
+
 re_comment_or_string = re.compile(
     r'#.*|/\*.*?\*/|"(?:\\.|[^\\"])*"'
 )
 
+re_label_prefix = re.compile(r'^[a-zA-Z0-9_]+:\s*')
+
+# Sections that can be switched to with a bare directive, and all sections
+# that GLOBAL_ASM blocks may contain
+SECTION_DIRECTIVES = frozenset(['.text', '.data', '.rdata', '.rodata', '.bss', '.late_rodata'])
+ASM_SECTIONS = frozenset(['.data', '.text', '.rodata', '.late_rodata', '.bss'])
+
+# String literal escapes, as understood by GNU as: \x followed by any number of
+# hex digits, up to three digits (0-7 would be more sane, but this matches GNU
+# as), or any other single character.
+re_string_escape = re.compile(r'\\(?:x[0-9a-fA-F]*|[0-9]{1,3}|.)', re.S)
+re_string_contents = re.compile(r'(?:[^"\\]+|' + re_string_escape.pattern + ')*', re.S)
+
+float_struct = struct.Struct(">f")
+double_struct = struct.Struct(">d")
+uint_struct = struct.Struct(">I")
+
 
 class Failure(Exception):
     def __init__(self, message):
@@ -455,23 +554,10 @@ class GlobalState:
         self.prelude_if_late_rodata = prelude_if_late_rodata
         self.mips1 = mips1
         self.pascal = pascal
-
-    def next_late_rodata_hex(self):
-        dummy_bytes = struct.pack('>I', self.late_rodata_hex)
-        if (self.late_rodata_hex & 0xffff) == 0:
-            # Avoid lui
-            self.late_rodata_hex += 1
-        self.late_rodata_hex += 1
-        return dummy_bytes
-
-    def make_name(self, cat):
-        self.namectr += 1
-        return '_asmpp_{}{}'.format(cat, self.namectr)
-
-    def func_prologue(self, name):
-        if self.pascal:
-            return " ".join([
-                "procedure {}();".format(name),
+        # Function wrappers for the dummy code, fixed for the whole file
+        if pascal:
+            self.prologue_template = " ".join([
+                "procedure {}();",
                 "type",
                 " pi = ^integer;",
                 " pf = ^single;",
@@ -485,14 +571,28 @@ class GlobalState:
                 " vf := vf;",
                 " vd := vd;",
             ])
+            self.epilogue = "end;"
         else:
-            return 'void {}(void) {{'.format(name)
+            self.prologue_template = 'void {}(void) {{'
+            self.epilogue = "}"
+
+    def next_late_rodata_hex(self):
+        dummy_bytes = uint_struct.pack(self.late_rodata_hex)
+        if (self.late_rodata_hex & 0xffff) == 0:
+            # Avoid lui
+            self.late_rodata_hex += 1
+        self.late_rodata_hex += 1
+        return dummy_bytes
+
+    def make_name(self, cat):
+        self.namectr += 1
+        return TEMP_NAME_PREFIX + cat + str(self.namectr)
+
+    def func_prologue(self, name):
+        return self.prologue_template.format(name)
 
     def func_epilogue(self):
-        if self.pascal:
-            return "end;"
-        else:
-            return "}"
+        return self.epilogue
 
     def pascal_assignment(self, tp, val):
         self.valuectr += 1
@@ -519,7 +619,8 @@ class GlobalAsmBlock:
             '.late_rodata': 0,
         }
         self.fn_ins_inds = []
-        self.glued_line = ''
+        # Pieces of a line continued with backslashes
+        self.glued_parts = []
         self.num_lines = 0
 
     def fail(self, message, line=None):
@@ -529,70 +630,52 @@ class GlobalAsmBlock:
         raise Failure(message + "\nwithin " + context)
 
     def count_quoted_size(self, line, z, real_line, output_enc):
-        line = line.encode(output_enc).decode('latin1')
-        in_quote = False
+        if not (line.isascii() and is_ascii_compatible(output_enc)):
+            line = line.encode(output_enc).decode('latin1')
         has_comma = True
         num_parts = 0
         ret = 0
-        i = 0
-        digits = "0123456789" # 0-7 would be more sane, but this matches GNU as
-        while i < len(line):
-            c = line[i]
-            i += 1
-            if not in_quote:
-                if c == '"':
-                    in_quote = True
-                    if z and not has_comma:
-                        self.fail(".asciiz with glued strings is not supported due to GNU as version diffs")
-                    num_parts += 1
-                elif c == ',':
-                    has_comma = True
-            else:
-                if c == '"':
-                    in_quote = False
-                    has_comma = False
-                    continue
-                ret += 1
-                if c != '\\':
-                    continue
-                if i == len(line):
-                    self.fail("backslash at end of line not supported", real_line)
-                c = line[i]
-                i += 1
-                # (if c is in "bfnrtv", we have a real escaped literal)
-                if c == 'x':
-                    # hex literal, consume any number of hex chars, possibly none
-                    while i < len(line) and line[i] in digits + "abcdefABCDEF":
-                        i += 1
-                elif c in digits:
-                    # octal literal, consume up to two more digits
-                    it = 0
-                    while i < len(line) and line[i] in digits and it < 2:
-                        i += 1
-                        it += 1
-
-        if in_quote:
-            self.fail("unterminated string literal", real_line)
+        pos = line.find('"')
+        while pos != -1:
+            if z and not has_comma:
+                self.fail(".asciiz with glued strings is not supported due to GNU as version diffs")
+            num_parts += 1
+            # The contents end either at the closing quote, at the end of the
+            # line, or at a backslash at the end of the line.
+            m = re_string_contents.match(line, pos + 1)
+            end = m.end()
+            if end == len(line):
+                self.fail("unterminated string literal", real_line)
+            if line[end] != '"':
+                self.fail("backslash at end of line not supported", real_line)
+            end += 1
+            # Each escape sequence counts as a single byte
+            unescaped, num_escapes = re_string_escape.subn('', m.group(0))
+            ret += len(unescaped) + num_escapes
+            pos = line.find('"', end)
+            has_comma = pos != -1 and ',' in line[end:pos]
+
         if num_parts == 0:
             self.fail(".ascii with no string", real_line)
         return ret + num_parts if z else ret
 
     def align2(self):
-        while self.fn_section_sizes[self.cur_section] % 2 != 0:
-            self.fn_section_sizes[self.cur_section] += 1
+        sizes = self.fn_section_sizes
+        sizes[self.cur_section] = (sizes[self.cur_section] + 1) & ~1
 
     def align4(self):
-        while self.fn_section_sizes[self.cur_section] % 4 != 0:
-            self.fn_section_sizes[self.cur_section] += 1
+        sizes = self.fn_section_sizes
+        sizes[self.cur_section] = (sizes[self.cur_section] + 3) & ~3
 
     def add_sized(self, size, line):
-        if self.cur_section in ['.text', '.late_rodata']:
+        section = self.cur_section
+        if section == '.text' or section == '.late_rodata':
             if size % 4 != 0:
                 self.fail("size must be a multiple of 4", line)
         if size < 0:
             self.fail("size cannot be negative", line)
-        self.fn_section_sizes[self.cur_section] += size
-        if self.cur_section == '.text':
+        self.fn_section_sizes[section] += size
+        if section == '.text':
             if not self.text_glabels:
                 self.fail(".text block without an initial glabel", line)
             self.fn_ins_inds.append((self.num_lines - 1, size // 4))
@@ -600,27 +683,49 @@ class GlobalAsmBlock:
     def process_line(self, line, output_enc):
         self.num_lines += 1
         if line.endswith('\\'):
-            self.glued_line += line[:-1]
+            self.glued_parts.append(line[:-1])
             return
-        line = self.glued_line + line
-        self.glued_line = ''
+        if self.glued_parts:
+            self.glued_parts.append(line)
+            line = ''.join(self.glued_parts)
+            self.glued_parts = []
 
         real_line = line
-        line = re.sub(re_comment_or_string, re_comment_replacer, line)
+        if '#' in line or '/*' in line or '"' in line:
+            line = re_comment_or_string.sub(re_comment_replacer, line)
         line = line.strip()
-        line = re.sub(r'^[a-zA-Z0-9_]+:\s*', '', line)
+        line = re_label_prefix.sub('', line)
         changed_section = False
         emitting_double = False
-        if (line.startswith('glabel ') or line.startswith('jlabel ')) and self.cur_section == '.text':
+        if line.startswith(('glabel ', 'jlabel ')) and self.cur_section == '.text':
             self.text_glabels.append(line.split()[1])
         if not line:
             pass # empty line
-        elif line.startswith('glabel ') or line.startswith('dlabel ') or line.startswith('jlabel ') or line.startswith('endlabel ') or (' ' not in line and line.endswith(':')):
+        elif line.startswith(('glabel ', 'dlabel ', 'jlabel ', 'endlabel ')) or (' ' not in line and line.endswith(':')):
             pass # label
-        elif line.startswith('.section') or line in ['.text', '.data', '.rdata', '.rodata', '.bss', '.late_rodata']:
+        elif not line.startswith('.'):
+            # Instruction. These are by far the most common lines, so handle
+            # them before the directives, which all start with a dot.
+            #
+            # Unfortunately, macros are hard to support for .rodata --
+            # we don't know how how space they will expand to before
+            # running the assembler, but we need that information to
+            # construct the C code. So if we need that we'll either
+            # need to run the assembler twice (at least in some rare
+            # cases), or change how this program is invoked.
+            # Similarly, we can't currently deal with pseudo-instructions
+            # that expand to several real instructions.
+            if self.cur_section != '.text':
+                self.fail("instruction or macro call in non-.text section? not supported", real_line)
+            self.add_sized(4, real_line)
+        # Directives, roughly in order of frequency where prefixes don't overlap
+        elif line.startswith(('.word', '.gpword', '.float')):
+            self.align4()
+            self.add_sized(4 * (line.count(',') + 1), real_line)
+        elif line in SECTION_DIRECTIVES or line.startswith('.section'):
             # section change
             self.cur_section = '.rodata' if line == '.rdata' else line.split(',')[0].split()[-1]
-            if self.cur_section not in ['.data', '.text', '.rodata', '.late_rodata', '.bss']:
+            if self.cur_section not in ASM_SECTIONS:
                 self.fail("unrecognized .section directive", real_line)
             changed_section = True
         elif line.startswith('.late_rodata_alignment'):
@@ -634,10 +739,7 @@ class GlobalAsmBlock:
             self.late_rodata_alignment = value
             changed_section = True
         elif line.startswith('.incbin'):
-            self.add_sized(int(line.split(',')[-1].strip(), 0), real_line)
-        elif line.startswith('.word') or line.startswith('.gpword') or line.startswith('.float'):
-            self.align4()
-            self.add_sized(4 * len(line.split(',')), real_line)
+            self.add_sized(int(line.rsplit(',', 1)[-1].strip(), 0), real_line)
         elif line.startswith('.double'):
             self.align4()
             if self.cur_section == '.late_rodata':
@@ -653,7 +755,7 @@ class GlobalAsmBlock:
                         self.fail("found two .double directives with different start addresses mod 8. Make sure to provide explicit alignment padding.", real_line)
                     else:
                         self.fail(".double at address that is not 0 mod 8 (based on .late_rodata_alignment assumption). Make sure to provide explicit alignment padding.", real_line)
-            self.add_sized(8 * len(line.split(',')), real_line)
+            self.add_sized(8 * (line.count(',') + 1), real_line)
             emitting_double = True
         elif line.startswith('.space'):
             self.add_sized(int(line.split()[1], 0), real_line)
@@ -668,37 +770,24 @@ class GlobalAsmBlock:
                 self.fail("only .align 2 is supported", real_line)
             self.align4()
         elif line.startswith('.asci'):
-            z = (line.startswith('.asciz') or line.startswith('.asciiz'))
+            z = line.startswith(('.asciz', '.asciiz'))
             self.add_sized(self.count_quoted_size(line, z, real_line, output_enc), real_line)
         elif line.startswith('.byte'):
-            self.add_sized(len(line.split(',')), real_line)
-        elif line.startswith('.half') or line.startswith('.hword') or line.startswith(".short"):
+            self.add_sized(line.count(',') + 1, real_line)
+        elif line.startswith(('.half', '.hword', '.short')):
             self.align2()
-            self.add_sized(2*len(line.split(',')), real_line)
+            self.add_sized(2 * (line.count(',') + 1), real_line)
         elif line.startswith('.size'):
             pass
-        elif line.startswith('.'):
+        else:
             # .macro, ...
             self.fail("asm directive not supported", real_line)
-        else:
-            # Unfortunately, macros are hard to support for .rodata --
-            # we don't know how how space they will expand to before
-            # running the assembler, but we need that information to
-            # construct the C code. So if we need that we'll either
-            # need to run the assembler twice (at least in some rare
-            # cases), or change how this program is invoked.
-            # Similarly, we can't currently deal with pseudo-instructions
-            # that expand to several real instructions.
-            if self.cur_section != '.text':
-                self.fail("instruction or macro call in non-.text section? not supported", real_line)
-            self.add_sized(4, real_line)
         if self.cur_section == '.late_rodata':
             if not changed_section:
                 if emitting_double:
-                    self.late_rodata_asm_conts.append(".align 0")
-                self.late_rodata_asm_conts.append(real_line)
-                if emitting_double:
-                    self.late_rodata_asm_conts.append(".align 2")
+                    self.late_rodata_asm_conts.extend((".align 0", real_line, ".align 2"))
+                else:
+                    self.late_rodata_asm_conts.append(real_line)
         else:
             self.asm_conts.append(real_line)
 
@@ -759,7 +848,7 @@ class GlobalAsmBlock:
                 if self.late_rodata_alignment == 4 * ((i + 1) % 2 + 1) and i + 1 < size:
                     dummy_bytes2 = state.next_late_rodata_hex()
                     late_rodata_dummy_bytes.append(dummy_bytes2)
-                    fval, = struct.unpack('>d', dummy_bytes + dummy_bytes2)
+                    fval, = double_struct.unpack(dummy_bytes + dummy_bytes2)
                     if state.pascal:
                         line = state.pascal_assignment('d', fval)
                     else:
@@ -773,7 +862,7 @@ class GlobalAsmBlock:
                         late_rodata_fn_output.append('')
                     extra_mips1_nop = False
                 else:
-                    fval, = struct.unpack('>f', dummy_bytes)
+                    fval, = float_struct.unpack(dummy_bytes)
                     if state.pascal:
                         line = state.pascal_assignment('f', fval)
                     else:
@@ -798,11 +887,24 @@ class GlobalAsmBlock:
             fn_emitted = 0
             fn_skipped = 0
             skipping = True
-            rodata_stack = late_rodata_fn_output[::-1]
+            # Late rodata statements are consumed in order, tracked by index
+            rodata_index = 0
+            rodata_count = len(late_rodata_fn_output)
             for (line, count) in self.fn_ins_inds:
+                if (not skipping and rodata_index == rodata_count and not state.pascal and
+                        fn_emitted + count <= MAX_FN_SIZE + 1):
+                    # Common case: only filler statements, and the function
+                    # doesn't need to be split within this line.
+                    src[line] += '*(volatile int*)0 = 0;' * count
+                    tot_emitted += count
+                    fn_emitted += count
+                    continue
+                # Collect the statements for the line and join them at the end,
+                # since a line like .space can stand for many instructions.
+                line_src = []
                 for _ in range(count):
                     if (fn_emitted > MAX_FN_SIZE and instr_count - tot_emitted > state.min_instr_count and
-                            (not rodata_stack or rodata_stack[-1])):
+                            (rodata_index == rodata_count or late_rodata_fn_output[rodata_index])):
                         # Don't let functions become too large. When a function reaches 284
                         # instructions, and -O2 -framepointer flags are passed, the IRIX
                         # compiler decides it is a great idea to start optimizing more.
@@ -811,27 +913,29 @@ class GlobalAsmBlock:
                         fn_emitted = 0
                         fn_skipped = 0
                         skipping = True
-                        src[line] += (' ' + state.func_epilogue() + ' ' +
+                        line_src.append(' ' + state.func_epilogue() + ' ' +
                             state.func_prologue(state.make_name('large_func')) + ' ')
                     if (
                         skipping and
                         fn_skipped < state.skip_instr_count +
-                            (state.prelude_if_late_rodata if rodata_stack else 0)
+                            (state.prelude_if_late_rodata if rodata_index < rodata_count else 0)
                     ):
                         fn_skipped += 1
                         tot_skipped += 1
                     else:
                         skipping = False
-                        if rodata_stack:
-                            src[line] += rodata_stack.pop()
+                        if rodata_index < rodata_count:
+                            line_src.append(late_rodata_fn_output[rodata_index])
+                            rodata_index += 1
                         elif state.pascal:
-                            src[line] += state.pascal_assignment('i', '0')
+                            line_src.append(state.pascal_assignment('i', '0'))
                         else:
-                            src[line] += '*(volatile int*)0 = 0;'
+                            line_src.append('*(volatile int*)0 = 0;')
                     tot_emitted += 1
                     fn_emitted += 1
-            if rodata_stack:
-                size = len(late_rodata_fn_output) // 3
+                src[line] += ''.join(line_src)
+            if rodata_index < rodata_count:
+                size = rodata_count // 3
                 available = instr_count - tot_skipped
                 self.fail(
                     "late rodata to text ratio is too high: {} / {} must be <= 1/3\n"
@@ -878,10 +982,45 @@ class GlobalAsmBlock:
         return src, fn
 
 cutscene_data_regexpr = re.compile(r"CutsceneData (.|\n)*\[\] = {")
-float_regexpr = re.compile(r"[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?f")
+float_regexpr = re.compile(r"([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)f")
+
+# Cutscene data tends to repeat the same few literals, so memoize conversions.
+@functools.lru_cache(maxsize=4096)
+def float_hex(text):
+    return str(uint_struct.unpack(float_struct.pack(float(text)))[0])
 
 def repl_float_hex(m):
-    return str(struct.unpack(">I", struct.pack(">f", float(m.group(0).strip().rstrip("f"))))[0])
+    return float_hex(m.group(1))
+
+def open_source(filename, encoding):
+    # Read the file in one go, rather than a line at a time, but decode it
+    # lazily while iterating. A fully decoded copy can take up to four bytes
+    # per character, which adds up for large generated files.
+    with open(filename, 'rb') as f:
+        data = BytesIO(f.read())
+    data.name = filename
+    return TextIOWrapper(data, encoding=encoding, newline=None)
+
+# Prefixes of lines that refer to assembly files, checked together first
+# since most lines won't match any of them
+ASM_FILE_PREFIXES = ('GLOBAL_ASM("', '#pragma GLOBAL_ASM("', 'INCLUDE_ASM("', 'INCLUDE_RODATA("')
+
+ASM_MARKERS = ('GLOBAL_ASM', 'INCLUDE_ASM', 'INCLUDE_RODATA', 'asmproc')
+
+def may_contain_asm(filename, encoding):
+    # Cheap check for whether parsing a file can produce any functions, by
+    # searching for the relevant keywords in its raw bytes. Only done for
+    # encodings that are ASCII-compatible; otherwise assume it might.
+    markers = [marker.encode(encoding) for marker in ASM_MARKERS]
+    if markers != [marker.encode('ascii') for marker in ASM_MARKERS]:
+        return True
+    with open(filename, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return any(mm.find(marker) != -1 for marker in markers)
+        except (ValueError, OSError):
+            data = f.read()
+            return any(marker in data for marker in markers)
 
 Opts = namedtuple('Opts', ['opt', 'framepointer', 'mips1', 'kpic', 'pascal', 'input_enc', 'output_enc', 'enable_cutscene_data_float_encoding'])
 
@@ -942,6 +1081,10 @@ def parse_source(f, opts, out_dependencies, print_source=None):
     is_cutscene_data = False
     is_early_include = False
 
+    # Bound methods for the per-line work, looked up once
+    add_output_line = output_lines.append
+    process_asm_line = None
+
     for line_no, raw_line in enumerate(f, 1):
         raw_line = raw_line.rstrip()
         line = raw_line.lstrip()
@@ -949,28 +1092,29 @@ def parse_source(f, opts, out_dependencies, print_source=None):
         # Print exactly one output line per source line, to make compiler
         # errors have correct line numbers. These will be overridden with
         # reasonable content further down.
-        output_lines.append('')
+        add_output_line('')
 
         if global_asm is not None:
             if line.startswith(')'):
                 src, fn = global_asm.finish(state)
-                for i, line2 in enumerate(src):
-                    output_lines[start_index + i] = line2
+                # src has one entry per line of the block, including this one
+                output_lines[start_index:] = src
                 asm_functions.append(fn)
                 global_asm = None
             else:
-                global_asm.process_line(raw_line, output_enc)
+                process_asm_line(raw_line, output_enc)
         elif line in ("GLOBAL_ASM(", "#pragma GLOBAL_ASM("):
             global_asm = GlobalAsmBlock("GLOBAL_ASM block at line " + str(line_no))
+            process_asm_line = global_asm.process_line
             start_index = len(output_lines)
-        elif (
-            (line.startswith('GLOBAL_ASM("') or line.startswith('#pragma GLOBAL_ASM("'))
+        elif line.startswith(ASM_FILE_PREFIXES) and ((
+            line.startswith(('GLOBAL_ASM("', '#pragma GLOBAL_ASM("'))
             and line.endswith('")')
         ) or (
-            (line.startswith('INCLUDE_ASM("') or line.startswith('INCLUDE_RODATA("'))
+            line.startswith(('INCLUDE_ASM("', 'INCLUDE_RODATA("'))
             and '",' in line
             and line.endswith(");")
-        ):
+        )):
             prologue = []
             if line.startswith("INCLUDE_"):
                 # INCLUDE_ASM("path/to", functionname);
@@ -985,7 +1129,7 @@ def parse_source(f, opts, out_dependencies, print_source=None):
             for line2 in prologue:
                 ext_global_asm.process_line(line2, output_enc)
             try:
-                f = open(fname, encoding=opts.input_enc)
+                f = open_source(fname, opts.input_enc)
             except FileNotFoundError:
                 # The GLOBAL_ASM block might be surrounded by an ifdef, so it's
                 # not clear whether a missing file actually represents a compile
@@ -1016,7 +1160,7 @@ def parse_source(f, opts, out_dependencies, print_source=None):
             fname = os.path.join(fpath, line[line.index(' ') + 2 : -1])
             out_dependencies.append(fname)
             include_src = StringIO()
-            with open(fname, encoding=opts.input_enc) as include_file:
+            with open_source(fname, opts.input_enc) as include_file:
                 parse_source(include_file, opts, out_dependencies, include_src)
             include_src.write('#line ' + str(line_no + 1) + ' "' + f.name + '"')
             output_lines[-1] = include_src.getvalue()
@@ -1025,35 +1169,49 @@ def parse_source(f, opts, out_dependencies, print_source=None):
             if opts.enable_cutscene_data_float_encoding:
                 # This is a hack to replace all floating-point numbers in an array of a particular type
                 # (in this case CutsceneData) with their corresponding IEEE-754 hexadecimal representation
-                if cutscene_data_regexpr.search(line) is not None:
+                if 'CutsceneData ' in line and cutscene_data_regexpr.search(line) is not None:
                     is_cutscene_data = True
                 elif line.endswith("};"):
                     is_cutscene_data = False
-                if is_cutscene_data:
-                    raw_line = re.sub(float_regexpr, repl_float_hex, raw_line)
+                if is_cutscene_data and 'f' in raw_line:
+                    raw_line = float_regexpr.sub(repl_float_hex, raw_line)
             output_lines[-1] = raw_line
 
     if print_source:
+        output = '\n'.join(output_lines) + '\n'
         if isinstance(print_source, StringIO):
-            for line in output_lines:
-                print_source.write(line + '\n')
+            print_source.write(output)
         else:
-            newline_encoded = "\n".encode(output_enc)
-            for line in output_lines:
-                try:
-                    line_encoded = line.encode(output_enc)
-                except UnicodeEncodeError:
-                    print("Failed to encode a line to", output_enc)
-                    print("The line:", line)
-                    print("The line, utf-8-encoded:", line.encode("utf-8"))
-                    raise
-                print_source.write(line_encoded)
-                print_source.write(newline_encoded)
+            try:
+                output_encoded = output.encode(output_enc)
+            except UnicodeEncodeError:
+                output_encoded = None
+            if output_encoded is not None:
+                print_source.write(output_encoded)
+            else:
+                # Redo the encoding line by line, to report the line that failed.
+                newline_encoded = "\n".encode(output_enc)
+                for line in output_lines:
+                    try:
+                        line_encoded = line.encode(output_enc)
+                    except UnicodeEncodeError:
+                        print("Failed to encode a line to", output_enc)
+                        print("The line:", line)
+                        print("The line, utf-8-encoded:", line.encode("utf-8"))
+                        raise
+                    print_source.write(line_encoded)
+                    print_source.write(newline_encoded)
             print_source.flush()
 
     return asm_functions
 
 def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, drop_mdebug_gptab, convert_statics):
+    # Only needed for post-processing, so imported lazily to keep the
+    # pre-processing step fast.
+    import subprocess
+    import tempfile
+    import shlex
+
     SECTIONS = ['.data', '.text', '.rodata', '.bss']
 
     with open(objfile_name, 'rb') as f:
@@ -1106,8 +1264,8 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
             if loc != prev_loc:
                 asm.append('.section ' + sectype)
                 if sectype == '.text':
-                    for i in range((loc - prev_loc) // 4):
-                        asm.append('nop')
+                    # Pad with nops, which are all zero bytes.
+                    asm.append('.fill {}, 4, 0'.format((loc - prev_loc) // 4))
                 else:
                     asm.append('.space {}'.format(loc - prev_loc))
             to_copy[sectype].append((loc, size, temp_name, function.fn_desc))
@@ -1131,8 +1289,8 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
                     asm.append('.section ' + sectype)
                     asm.append('glabel ' + temp_name + '_asm_end')
     if any(late_rodata_asm):
-        late_rodata_source_name_start = '_asmpp_late_rodata_start'
-        late_rodata_source_name_end = '_asmpp_late_rodata_end'
+        late_rodata_source_name_start = TEMP_NAME_PREFIX + 'late_rodata_start'
+        late_rodata_source_name_end = TEMP_NAME_PREFIX + 'late_rodata_end'
         asm.append('.section .late_rodata')
         # Put some padding at the start to avoid conflating symbols with
         # references to the whole section.
@@ -1149,12 +1307,20 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
     s_name = s_file.name
     try:
         s_file.write(asm_prelude + b'\n')
-        for line in asm:
-            s_file.write(line.encode(output_enc) + b'\n')
+        s_file.write(('\n'.join(asm) + '\n').encode(output_enc))
         s_file.close()
-        ret = os.system(assembler + " " + s_name + " -o " + o_name)
+        # Run the assembler directly rather than through a shell.
+        try:
+            cmd = shlex.split(assembler) + [s_name, "-o", o_name]
+        except ValueError as e:
+            raise Failure("invalid assembler command {!r}: {}".format(assembler, e))
+        cmd_str = " ".join(shlex.quote(x) for x in cmd)
+        try:
+            ret = subprocess.run(cmd).returncode
+        except OSError as e:
+            raise Failure("failed to assemble: could not run {}: {}".format(cmd_str, e))
         if ret != 0:
-            raise Failure("failed to assemble")
+            raise Failure("failed to assemble: {} exited with status {}".format(cmd_str, ret))
         with open(o_name, 'rb') as f:
             asm_objfile = ElfFile(f.read())
 
@@ -1168,11 +1334,10 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
         # Unify reginfo sections
         target_reginfo = objfile.find_section('.reginfo')
         if target_reginfo is not None:
-            source_reginfo_data = list(asm_objfile.find_section('.reginfo').data)
-            data = list(target_reginfo.data)
-            for i in range(20):
-                data[i] |= source_reginfo_data[i]
-            target_reginfo.data = bytes(data)
+            # OR together the register masks (the first 20 bytes), as one big integer.
+            source_reginfo_data = asm_objfile.find_section('.reginfo').data
+            mask = int.from_bytes(target_reginfo.data[:20], 'big') | int.from_bytes(source_reginfo_data[:20], 'big')
+            target_reginfo.data = mask.to_bytes(20, 'big') + target_reginfo.data[20:]
 
         # Move over section contents
         modified_text_positions = set()
@@ -1193,14 +1358,13 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
                 continue
             target = objfile.find_section(sectype)
             assert target is not None, "missing target section of type " + sectype
-            data = list(target.data)
+            data = bytearray(target.data)
             for (pos, count, _, _) in to_copy[sectype]:
                 data[pos:pos + count] = source.data[pos:pos + count]
                 if sectype == '.text':
                     assert count % 4 == 0
                     assert pos % 4 == 0
-                    for i in range(count // 4):
-                        modified_text_positions.add(pos + 4 * i)
+                    modified_text_positions.update(range(pos, pos + count, 4))
                 elif sectype == '.rodata':
                     last_rodata_pos = pos + count
             target.data = bytes(data)
@@ -1215,14 +1379,24 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
             source_end = asm_objfile.symtab.find_symbol_in_section(late_rodata_source_name_end, source)
             if source_end - source_pos != sum(map(len, all_late_rodata_dummy_bytes)) * 4 + sum(all_jtbl_rodata_size):
                 raise Failure("computed wrong size of .late_rodata")
-            new_data = list(target.data)
+            new_data = bytearray(target.data)
+            if SLOW_CHECKS:
+                # Find the last occurrence of every dummy value in a single
+                # scan, rather than searching the rest of the section for each.
+                all_dummy_bytes = [dummy_bytes if fmt.is_big_endian else dummy_bytes[::-1]
+                        for dummy_bytes_list in all_late_rodata_dummy_bytes for dummy_bytes in dummy_bytes_list]
+                dummy_regexpr = re.compile(b'(?=(' + b'|'.join(map(re.escape, all_dummy_bytes)) + b'))')
+                last_occurrence = {m.group(1): m.start() for m in dummy_regexpr.finditer(target.data)}
+            # The source data is consumed in order, so gather the copies into
+            # runs that are contiguous in the target, and copy those at the end.
+            copy_runs = []
             for dummy_bytes_list, jtbl_rodata_size in zip(all_late_rodata_dummy_bytes, all_jtbl_rodata_size):
                 for index, dummy_bytes in enumerate(dummy_bytes_list):
                     if not fmt.is_big_endian:
                         dummy_bytes = dummy_bytes[::-1]
+                    # The searches are monotonic, so this scans each byte about once.
                     pos = target.data.index(dummy_bytes, last_rodata_pos)
-                    # This check is nice, but makes time complexity worse for large files:
-                    if SLOW_CHECKS and target.data.find(dummy_bytes, pos + 4) != -1:
+                    if SLOW_CHECKS and last_occurrence[dummy_bytes] >= pos + 4:
                         raise Failure("multiple occurrences of late_rodata hex magic. Change asm-processor to use something better than 0xE0123456!")
                     if index == 0 and len(dummy_bytes_list) > 1 and target.data[pos+4:pos+8] == b'\0\0\0\0':
                         # Ugly hack to handle double alignment for non-matching builds.
@@ -1233,49 +1407,52 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
                         # tables correct, move the float by 4 bytes as well.
                         new_data[pos:pos+4] = b'\0\0\0\0'
                         pos += 4
-                    new_data[pos:pos+4] = source.data[source_pos:source_pos+4]
+                    if copy_runs and copy_runs[-1][0] + copy_runs[-1][2] == pos:
+                        copy_runs[-1][2] += 4
+                    else:
+                        copy_runs.append([pos, source_pos, 4])
                     moved_late_rodata[source_pos] = pos
                     last_rodata_pos = pos + 4
                     source_pos += 4
                 if jtbl_rodata_size > 0:
                     assert dummy_bytes_list, "should always have dummy bytes before jtbl data"
                     pos = last_rodata_pos
-                    new_data[pos : pos + jtbl_rodata_size] = \
-                        source.data[source_pos : source_pos + jtbl_rodata_size]
+                    copy_runs[-1][2] += jtbl_rodata_size
                     for i in range(0, jtbl_rodata_size, 4):
                         moved_late_rodata[source_pos + i] = pos + i
                         jtbl_rodata_positions.add(pos + i)
                     last_rodata_pos += jtbl_rodata_size
                     source_pos += jtbl_rodata_size
+            for pos, source_pos, size in copy_runs:
+                new_data[pos : pos + size] = source.data[source_pos : source_pos + size]
             target.data = bytes(new_data)
 
         # Merge strtab data.
         strtab_adj = len(objfile.symtab.strtab.data)
         objfile.symtab.strtab.data += asm_objfile.symtab.strtab.data
 
-        # Find relocated symbols
-        relocated_symbols = set()
+        # Find relocated symbols. Only the ones from the assembly file are
+        # ever looked up, so keep track of those by symbol index.
+        relocated_symbol_indices = set()
         for sectype in SECTIONS + ['.late_rodata']:
-            for obj in [asm_objfile, objfile]:
-                sec = obj.find_section(sectype)
-                if sec is None:
-                    continue
-                for reltab in sec.relocated_by:
-                    for rel in reltab.relocations:
-                        relocated_symbols.add(obj.symtab.symbol_entries[rel.sym_index])
+            sec = asm_objfile.find_section(sectype)
+            if sec is None:
+                continue
+            for reltab in sec.relocated_by:
+                relocated_symbol_indices.update(rel.sym_index for rel in reltab.relocations)
 
         # Move over symbols, deleting the temporary function labels.
         # Skip over new local symbols that aren't relocated against, to
         # avoid conflicts.
         empty_symbol = objfile.symtab.symbol_entries[0]
-        new_syms = [s for s in objfile.symtab.symbol_entries[1:] if not is_temp_name(s.name)]
+        new_syms = [s for s in objfile.symtab.symbol_entries[1:] if not s.name.startswith(TEMP_NAME_PREFIX)]
 
         for i, s in enumerate(asm_objfile.symtab.symbol_entries):
             is_local = (i < asm_objfile.symtab.sh_info)
-            if is_local and s not in relocated_symbols:
+            if is_local and i not in relocated_symbol_indices:
                 continue
-            if is_temp_name(s.name):
-                assert s not in relocated_symbols
+            if s.name.startswith(TEMP_NAME_PREFIX):
+                assert i not in relocated_symbol_indices
                 continue
             if s.st_shndx not in [SHN_UNDEF, SHN_ABS]:
                 section_name = asm_objfile.sections[s.st_shndx].name
@@ -1311,16 +1488,16 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
             static_name_count = {}
             strtab_index = len(objfile.symtab.strtab.data)
             new_strtab_data = []
-            ifd_max, cb_fd_offset = fmt.unpack('II', mdebug_section.data[18*4 : 20*4])
-            cb_sym_offset, = fmt.unpack('I', mdebug_section.data[9*4 : 10*4])
-            cb_ss_offset, = fmt.unpack('I', mdebug_section.data[15*4 : 16*4])
+            ifd_max, cb_fd_offset = fmt.unpack_from('II', mdebug_section.data, 18*4)
+            cb_sym_offset, = fmt.unpack_from('I', mdebug_section.data, 9*4)
+            cb_ss_offset, = fmt.unpack_from('I', mdebug_section.data, 15*4)
+            objfile_view = memoryview(objfile.data)
             for i in range(ifd_max):
                 offset = cb_fd_offset + 18*4*i
-                iss_base, _, isym_base, csym = fmt.unpack('IIII', objfile.data[offset + 2*4 : offset + 6*4])
+                iss_base, _, isym_base, csym = fmt.unpack_from('IIII', objfile.data, offset + 2*4)
                 scope_level = 0
-                for j in range(csym):
-                    offset2 = cb_sym_offset + 12 * (isym_base + j)
-                    iss, value, st_sc_index = fmt.unpack('III', objfile.data[offset2 : offset2 + 12])
+                sym_offset = cb_sym_offset + 12 * isym_base
+                for iss, value, st_sc_index in fmt.iter_unpack('III', objfile_view[sym_offset : sym_offset + 12 * csym]):
                     st = (st_sc_index >> 26)
                     sc = (st_sc_index >> 21) & 0x1f
                     if st in (MIPS_DEBUG_ST_STATIC, MIPS_DEBUG_ST_STATIC_PROC):
@@ -1374,11 +1551,13 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
 
         # Get rid of duplicate symbols, favoring ones that are not UNDEF.
         # Skip this for unnamed local symbols though.
-        new_syms.sort(key=lambda s: 0 if s.st_shndx != SHN_UNDEF else 1)
+        # (A stable partition, which is cheaper than sorting.)
+        defined_syms = [s for s in new_syms if s.st_shndx != SHN_UNDEF]
+        undefined_syms = [s for s in new_syms if s.st_shndx == SHN_UNDEF]
         old_syms = []
         newer_syms = []
         name_to_sym = {}
-        for s in new_syms:
+        for s in defined_syms + undefined_syms:
             if s.name == "_gp_disp":
                 s.type = STT_OBJECT
             if s.bind == STB_LOCAL and s.st_shndx == SHN_UNDEF:
@@ -1402,37 +1581,49 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
         new_syms = newer_syms
 
         # Put local symbols in front, with the initial dummy entry first, and
-        # _gp_disp at the end if it exists.
-        new_syms.insert(0, empty_symbol)
-        new_syms.sort(key=lambda s: (s.bind != STB_LOCAL, s.name == "_gp_disp"))
-        num_local_syms = sum(1 for s in new_syms if s.bind == STB_LOCAL)
+        # _gp_disp at the end if it exists. This is a stable partition into
+        # (is global, is _gp_disp) buckets, so it takes a single pass.
+        buckets = ([], [], [], [])
+        for s in [empty_symbol] + new_syms:
+            buckets[2 * (s.bind != STB_LOCAL) + (s.name == "_gp_disp")].append(s)
+        new_syms = buckets[0] + buckets[1] + buckets[2] + buckets[3]
+        num_local_syms = len(buckets[0]) + len(buckets[1])
 
         for i, s in enumerate(new_syms):
             s.new_index = i
         for s in old_syms:
             s.new_index = s.replace_by.new_index
-        objfile.symtab.data = b''.join(s.to_bin() for s in new_syms)
+        objfile.symtab.data = pack_entries(new_syms, objfile.symtab.sh_entsize)
         objfile.symtab.sh_info = num_local_syms
 
+        # Tables mapping old symbol indices to new ones, for fixing up
+        # relocations. Dropped symbols don't have a new index.
+        objfile_sym_remap = [getattr(s, 'new_index', None) for s in objfile.symtab.symbol_entries]
+        asm_sym_remap = [getattr(s, 'new_index', None) for s in asm_objfile.symtab.symbol_entries]
+
         # Fix up relocation symbol references
         for sectype in SECTIONS:
             target = objfile.find_section(sectype)
 
             if target is not None:
+                # don't include relocations for late_rodata dummy code
+                if sectype == '.text':
+                    dropped_positions = modified_text_positions
+                elif sectype == '.rodata':
+                    dropped_positions = jtbl_rodata_positions
+                else:
+                    dropped_positions = ()
                 # fixup relocation symbol indices, since we butchered them above
                 for reltab in target.relocated_by:
-                    nrels = []
-                    for rel in reltab.relocations:
-                        if (sectype == '.text' and rel.r_offset in modified_text_positions or
-                            sectype == '.rodata' and rel.r_offset in jtbl_rodata_positions):
-                            # don't include relocations for late_rodata dummy code
-                            continue
-                        rel.sym_index = objfile.symtab.symbol_entries[rel.sym_index].new_index
-                        nrels.append(rel)
+                    nrels = [rel for rel in reltab.relocations if rel.r_offset not in dropped_positions]
+                    for rel in nrels:
+                        rel.sym_index = objfile_sym_remap[rel.sym_index]
                     reltab.relocations = nrels
-                    reltab.data = b''.join(rel.to_bin() for rel in nrels)
+                    reltab.data = pack_entries(nrels, reltab.sh_entsize)
 
-        # Move over relocations
+        # Move over relocations. The new relocation data is gathered per
+        # relocation section and appended in one go at the end.
+        new_rel_data = {}
         for sectype in SECTIONS + ['.late_rodata']:
             source = asm_objfile.find_section(sectype)
             if source is None or not source.data:
@@ -1445,24 +1636,27 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
             target_reltaba = objfile.find_section('.rela' + target_sectype)
             for reltab in source.relocated_by:
                 for rel in reltab.relocations:
-                    rel.sym_index = asm_objfile.symtab.symbol_entries[rel.sym_index].new_index
-                    if sectype == '.late_rodata':
+                    rel.sym_index = asm_sym_remap[rel.sym_index]
+                if sectype == '.late_rodata':
+                    for rel in reltab.relocations:
                         rel.r_offset = moved_late_rodata[rel.r_offset]
-                new_data = b''.join(rel.to_bin() for rel in reltab.relocations)
+                new_data = pack_entries(reltab.relocations, reltab.sh_entsize)
                 if reltab.sh_type == SHT_REL:
                     if not target_reltab:
                         target_reltab = objfile.add_section('.rel' + target_sectype,
                                 sh_type=SHT_REL, sh_flags=0,
                                 sh_link=objfile.symtab.index, sh_info=target.index,
                                 sh_addralign=4, sh_entsize=8, data=b'')
-                    target_reltab.data += new_data
+                    new_rel_data.setdefault(target_reltab, []).append(new_data)
                 else:
                     if not target_reltaba:
                         target_reltaba = objfile.add_section('.rela' + target_sectype,
                                 sh_type=SHT_RELA, sh_flags=0,
                                 sh_link=objfile.symtab.index, sh_info=target.index,
                                 sh_addralign=4, sh_entsize=12, data=b'')
-                    target_reltaba.data += new_data
+                    new_rel_data.setdefault(target_reltaba, []).append(new_data)
+        for reltab, chunks in new_rel_data.items():
+            reltab.data += b''.join(chunks)
 
         objfile.write(objfile_name)
     finally:
@@ -1473,17 +1667,119 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, d
         except:
             pass
 
-def run_wrapped(argv, outfile, functions):
+def file_stat_key(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def parse_cache_key(filename, opts):
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    # Changes to asm-processor itself should invalidate the cache.
+    with open(__file__, 'rb') as f:
+        h.update(f.read())
+    # Output depends on the file name (#line directives) and on the working
+    # directory (GLOBAL_ASM paths are relative to it), not just on contents.
+    h.update(repr((os.getcwd(), filename, opts)).encode('utf-8'))
+    with open(filename, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def read_parse_result(path, filename, opts):
+    import pickle
+    try:
+        with open(path, 'rb') as f:
+            entry_filename, entry_opts, dep_stats, functions, deps, source = pickle.load(f)
+        # The entry must be for this very file, in case a cache path is
+        # reused for another source file.
+        if entry_filename != os.path.realpath(filename) or entry_opts != tuple(opts):
+            return None
+        for dep, stat_key in dep_stats:
+            if file_stat_key(dep) != stat_key:
+                return None
+    except Exception:
+        return None
+    return [Function(*fn) for fn in functions], deps, source
+
+def write_parse_result(path, filename, opts, tracked_files, functions, deps, source):
+    import pickle
+    import tempfile
+    out_dir = os.path.dirname(path) or '.'
+    os.makedirs(out_dir, exist_ok=True)
+    dep_stats = [(dep, file_stat_key(dep)) for dep in tracked_files]
+    # Functions are stored as plain tuples, since pickling the namedtuple
+    # would tie the file to the name of the module that wrote it.
+    entry = (os.path.realpath(filename), tuple(opts), dep_stats, [tuple(fn) for fn in functions], deps, source)
+    fd, tmp_name = tempfile.mkstemp(dir=out_dir, prefix='asm-processor', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, path)
+    except:
+        os.remove(tmp_name)
+        raise
+
+def evict_parse_cache(cache_dir, max_entries):
+    entries = [e for e in os.scandir(cache_dir) if e.name.endswith('.pkl')]
+    if len(entries) > max_entries:
+        def mtime(e):
+            # Entries may be removed by other processes at any time
+            try:
+                return e.stat().st_mtime_ns
+            except OSError:
+                return 0
+        entries.sort(key=mtime)
+        for e in entries[:len(entries) - max_entries]:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+
+def parse_source_cached(filename, opts, cache_dir, max_entries=CACHE_MAX_ENTRIES):
+    cache_path = os.path.join(cache_dir, parse_cache_key(filename, opts) + '.pkl')
+    cached = read_parse_result(cache_path, filename, opts)
+    if cached is not None:
+        # Bump mtime, which is what eviction goes by. Another process may
+        # have evicted the entry in the meantime, which is fine.
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return cached
+    deps = []
+    print_source = BytesIO()
+    with open_source(filename, opts.input_enc) as f:
+        functions = parse_source(f, opts, out_dependencies=deps, print_source=print_source)
+    source = print_source.getvalue()
+    # A GLOBAL_ASM file that doesn't exist yet isn't tracked as a dependency,
+    # so don't cache output that refers to one.
+    if b'#include "GLOBAL_ASM:' not in source:
+        # The cache is only an optimization, so if it can't be written to
+        # (read-only, disk full, ...) just carry on without it.
+        try:
+            write_parse_result(cache_path, filename, opts, deps, functions, deps, source)
+            evict_parse_cache(cache_dir, max_entries)
+        except OSError:
+            pass
+    return functions, deps, source
+
+CONVERT_STATICS_CHOICES = ["no", "local", "global", "global-with-filename"]
+
+@functools.lru_cache(maxsize=1)
+def build_parser():
+    import argparse
     parser = argparse.ArgumentParser(description="Pre-process .c files and post-process .o files to enable embedding assembly into C.")
     parser.add_argument('filename', help="path to .c code")
     parser.add_argument('--post-process', dest='objfile', help="path to .o file to post-process")
-    parser.add_argument('--assembler', dest='assembler', help="assembler command (e.g. \"mips-linux-gnu-as -march=vr4300 -mabi=32\")")
+    parser.add_argument('--assembler', dest='assembler', help="assembler command (e.g. \"mips-linux-gnu-as -march=vr4300 -mabi=32\"); split with shell-like quoting but not run through a shell, so environment assignments, redirections and pipes are not supported")
     parser.add_argument('--asm-prelude', dest='asm_prelude', help="path to a file containing a prelude to the assembly file (with .set and .macro directives, e.g.)")
     parser.add_argument('--input-enc', default='latin1', help="input encoding (default: %(default)s)")
     parser.add_argument('--output-enc', default='latin1', help="output encoding (default: %(default)s)")
     parser.add_argument('--drop-mdebug-gptab', dest='drop_mdebug_gptab', action='store_true', help="drop mdebug and gptab sections")
-    parser.add_argument('--convert-statics', dest='convert_statics', choices=["no", "local", "global", "global-with-filename"], default="local", help="change static symbol visibility (default: %(default)s)")
+    parser.add_argument('--convert-statics', dest='convert_statics', choices=CONVERT_STATICS_CHOICES, default="local", help="change static symbol visibility (default: %(default)s)")
     parser.add_argument('--force', dest='force', action='store_true', help="force processing of files without GLOBAL_ASM blocks")
+    parser.add_argument('--functions-cache', dest='functions_cache', help="file in which to store the parse result when pre-processing, and from which to load it when post-processing if the source is unchanged")
+    parser.add_argument('--cache-dir', dest='cache_dir', help="directory for caching parsed source files across runs (default: no caching)")
+    parser.add_argument('--cache-max-entries', dest='cache_max_entries', type=int, default=CACHE_MAX_ENTRIES, help="number of entries to keep in --cache-dir, least recently used ones are evicted first (default: %(default)s)")
     parser.add_argument('--encode-cutscene-data-floats', dest='enable_cutscene_data_float_encoding', action='store_true', default=False, help="Replace floats with their encoded hexadecimal representation in CutsceneData data")
     parser.add_argument('-framepointer', dest='framepointer', action='store_true')
     parser.add_argument('-mips1', dest='mips1', action='store_true')
@@ -1494,9 +1790,119 @@ def run_wrapped(argv, outfile, functions):
     group.add_argument('-O1', dest='opt', action='store_const', const='O1')
     group.add_argument('-O2', dest='opt', action='store_const', const='O2')
     group.add_argument('-g', dest='opt', action='store_const', const='g')
-    args = parser.parse_args(argv)
+    return parser
+
+# Fast path for parse_argv, mirroring build_parser. Keep the two in sync.
+FAST_ARGV_DEFAULTS = {
+    'objfile': None,
+    'assembler': None,
+    'asm_prelude': None,
+    'input_enc': 'latin1',
+    'output_enc': 'latin1',
+    'drop_mdebug_gptab': False,
+    'convert_statics': 'local',
+    'force': False,
+    'functions_cache': None,
+    'cache_dir': None,
+    'cache_max_entries': CACHE_MAX_ENTRIES,
+    'enable_cutscene_data_float_encoding': False,
+    'framepointer': False,
+    'mips1': False,
+    'g3': False,
+    'kpic': False,
+}
+FAST_ARGV_VALUE_OPTIONS = {
+    '--post-process': 'objfile',
+    '--assembler': 'assembler',
+    '--asm-prelude': 'asm_prelude',
+    '--input-enc': 'input_enc',
+    '--output-enc': 'output_enc',
+    '--convert-statics': 'convert_statics',
+    '--functions-cache': 'functions_cache',
+    '--cache-dir': 'cache_dir',
+    '--cache-max-entries': 'cache_max_entries',
+}
+FAST_ARGV_FLAGS = {
+    '--drop-mdebug-gptab': 'drop_mdebug_gptab',
+    '--force': 'force',
+    '--encode-cutscene-data-floats': 'enable_cutscene_data_float_encoding',
+    '-framepointer': 'framepointer',
+    '-mips1': 'mips1',
+    '-g3': 'g3',
+    '-KPIC': 'kpic',
+}
+FAST_ARGV_OPT_LEVELS = {
+    '-O0': 'O0',
+    '-O1': 'O1',
+    '-O2': 'O2',
+    '-g': 'g',
+}
+
+def parse_argv_fast(argv):
+    # Handles the command lines that build scripts generate without going
+    # through argparse. Anything out of the ordinary (unknown or abbreviated
+    # options, --opt=value, conflicting optimization levels, ...) returns
+    # None, so that argparse can deal with it and report errors.
+    values = dict(FAST_ARGV_DEFAULTS)
+    filename = None
+    opt = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg in FAST_ARGV_FLAGS:
+            values[FAST_ARGV_FLAGS[arg]] = True
+        elif arg in FAST_ARGV_VALUE_OPTIONS:
+            if i == len(argv) or argv[i].startswith('-'):
+                return None
+            values[FAST_ARGV_VALUE_OPTIONS[arg]] = argv[i]
+            i += 1
+        elif arg in FAST_ARGV_OPT_LEVELS:
+            if opt is not None and opt != FAST_ARGV_OPT_LEVELS[arg]:
+                return None
+            opt = FAST_ARGV_OPT_LEVELS[arg]
+        elif arg.startswith('-') or filename is not None:
+            return None
+        else:
+            filename = arg
+    if filename is None or opt is None:
+        return None
+    if values['convert_statics'] not in CONVERT_STATICS_CHOICES:
+        return None
+    if isinstance(values['cache_max_entries'], str):
+        # Leave anything int() rejects to argparse, which reports it properly
+        try:
+            values['cache_max_entries'] = int(values['cache_max_entries'])
+        except ValueError:
+            return None
+    values['filename'] = filename
+    values['opt'] = opt
+    return SimpleNamespace(**values)
+
+def parse_argv(argv):
+    args = parse_argv_fast(argv)
+    if args is None:
+        args = build_parser().parse_args(argv)
+    return args
+
+# The prelude is usually shared by every file in a project, so keep it around
+# when running several jobs in one process.
+asm_prelude_cache = {}
+
+def read_asm_prelude(path):
+    stat = file_stat_key(path)
+    cached = asm_prelude_cache.get(path)
+    if cached is not None and cached[0] == stat:
+        return cached[1]
+    with open(path, 'rb') as f:
+        data = f.read()
+    asm_prelude_cache[path] = (stat, data)
+    return data
+
+def run_wrapped(argv, outfile, functions):
+    args = parse_argv(argv)
     opt = args.opt
-    pascal = any(args.filename.endswith(ext) for ext in (".p", ".pas", ".pp"))
+    pascal = args.filename.endswith((".p", ".pas", ".pp"))
     if args.g3:
         if opt != 'O2':
             raise Failure("-g3 is only supported together with -O2")
@@ -1508,22 +1914,60 @@ def run_wrapped(argv, outfile, functions):
     opts = Opts(opt, args.framepointer, args.mips1, args.kpic, pascal, args.input_enc, args.output_enc, args.enable_cutscene_data_float_encoding)
 
     if args.objfile is None:
-        with open(args.filename, encoding=args.input_enc) as f:
+        source = None
+        if args.cache_dir:
+            functions, deps, source = parse_source_cached(args.filename, opts, args.cache_dir, args.cache_max_entries)
+        elif args.functions_cache:
+            # Keep the output around so that it can be checked for missing
+            # GLOBAL_ASM files below.
             deps = []
-            functions = parse_source(f, opts, out_dependencies=deps, print_source=outfile)
-            return functions, deps
+            print_source = BytesIO()
+            with open_source(args.filename, args.input_enc) as f:
+                functions = parse_source(f, opts, out_dependencies=deps, print_source=print_source)
+            source = print_source.getvalue()
+        else:
+            with open_source(args.filename, args.input_enc) as f:
+                deps = []
+                functions = parse_source(f, opts, out_dependencies=deps, print_source=outfile)
+        if source is not None:
+            if isinstance(outfile, StringIO):
+                outfile.write(source.decode(args.output_enc))
+            elif outfile:
+                outfile.write(source)
+                outfile.flush()
+        if args.functions_cache:
+            try:
+                # As with --cache-dir, a GLOBAL_ASM file that doesn't exist
+                # yet isn't tracked as a dependency. Rather than storing a
+                # result that would go stale once it appears, remove any
+                # earlier one, so that post-processing parses the source.
+                if b'#include "GLOBAL_ASM:' in source:
+                    if os.path.exists(args.functions_cache):
+                        os.remove(args.functions_cache)
+                else:
+                    write_parse_result(args.functions_cache, args.filename, opts, [args.filename] + deps, functions, deps, None)
+            except OSError as e:
+                raise Failure("cannot write --functions-cache {}: {}".format(args.functions_cache, e))
+        return functions, deps
     else:
         if args.assembler is None:
             raise Failure("must pass assembler command")
-        if functions is None:
-            with open(args.filename, encoding=args.input_enc) as f:
+        if functions is None and args.functions_cache:
+            cached = read_parse_result(args.functions_cache, args.filename, opts)
+            if cached is not None:
+                functions = cached[0]
+        if functions is None and not args.force and not may_contain_asm(args.filename, args.input_enc):
+            return
+        if functions is None and args.cache_dir:
+            functions = parse_source_cached(args.filename, opts, args.cache_dir, args.cache_max_entries)[0]
+        elif functions is None:
+            with open_source(args.filename, args.input_enc) as f:
                 functions = parse_source(f, opts, out_dependencies=[])
         if not functions and not args.force:
             return
         asm_prelude = b''
         if args.asm_prelude:
-            with open(args.asm_prelude, 'rb') as f:
-                asm_prelude = f.read()
+            asm_prelude = read_asm_prelude(args.asm_prelude)
         fixup_objfile(args.objfile, functions, asm_prelude, args.assembler, args.output_enc, args.drop_mdebug_gptab, args.convert_statics)
 
 def run(argv, outfile=sys.stdout.buffer, functions=None):
@@ -1533,5 +1977,112 @@ def run(argv, outfile=sys.stdout.buffer, functions=None):
         print("Error:", e, file=sys.stderr)
         sys.exit(1)
 
+def run_job(job):
+    # A job is an (argv, output path) pair. The output path is where the
+    # pre-processed source is written, and may be None for post-processing.
+    # Errors of any kind are reported per job rather than taking down the
+    # whole batch.
+    argv, output = job
+    tmp_name = None
+    try:
+        if output is None:
+            return run_wrapped(argv, None, None), None
+        # Write to a temporary file first, and only move it into place once
+        # the job has succeeded, so that a failed job doesn't leave behind a
+        # truncated output file that looks up to date to the build system.
+        tmp_name = output + '.' + str(os.getpid()) + '.tmp'
+        try:
+            f = open(tmp_name, 'wb')
+        except OSError as e:
+            tmp_name = None
+            raise Failure("cannot write {}: {}".format(output, e.strerror))
+        with f:
+            result = run_wrapped(argv, f, None)
+        os.replace(tmp_name, output)
+        tmp_name = None
+        return result, None
+    except Failure as e:
+        return None, str(e)
+    except SystemExit as e:
+        # e.g. from argparse, which has already printed the reason to stderr
+        return None, "exited with status " + str(e.code)
+    except Exception as e:
+        return None, type(e).__name__ + ": " + str(e)
+    finally:
+        if tmp_name is not None:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+
+def run_batch(jobs, max_workers=None):
+    # Run independent jobs in parallel, paying for interpreter startup once
+    # per worker rather than once per file. Returns a (result, error message)
+    # pair for each job.
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_job, jobs))
+
+def serve(infile, outfile):
+    # Read one job per line, as the output path ('-' for none) followed by
+    # the arguments, and answer each with a line of "ok" or "error: ...".
+    # This lets a build system keep a single warm process around instead of
+    # starting a new interpreter per file.
+    import shlex
+    for line in infile:
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            # e.g. unbalanced quotes; reply and keep serving
+            outfile.write("error: " + str(e) + "\n")
+            outfile.flush()
+            continue
+        if not words:
+            continue
+        output = None if words[0] == '-' else words[0]
+        _, error = run_job((words[1:], output))
+        outfile.write("ok\n" if error is None else "error: " + error.replace("\n", " ") + "\n")
+        outfile.flush()
+
+def main(argv):
+    if argv == ['--server']:
+        # Keep the original stdout for replies only. Anything else that would
+        # go there, like diagnostics or the assembler's output, goes to stderr
+        # instead, so that it can't get mixed up with the replies.
+        sys.stdout.flush()
+        replies = os.fdopen(os.dup(1), 'w')
+        os.dup2(2, 1)
+        sys.stdout = sys.stderr
+        serve(sys.stdin, replies)
+        return
+    if argv[:1] == ['--jobs-file']:
+        if len(argv) != 2:
+            print("usage: asm_processor.py --jobs-file FILE", file=sys.stderr)
+            sys.exit(2)
+        import json
+        with open(argv[1]) as f:
+            try:
+                jobs = json.load(f)
+            except ValueError as e:
+                print("Error: invalid jobs file {}: {}".format(argv[1], e), file=sys.stderr)
+                sys.exit(2)
+        def valid_job(job):
+            return (isinstance(job, list) and len(job) == 2
+                    and isinstance(job[0], list) and all(isinstance(a, str) for a in job[0])
+                    and (job[1] is None or isinstance(job[1], str)))
+        if not isinstance(jobs, list) or not all(valid_job(job) for job in jobs):
+            print("Error: invalid jobs file {}: expected a list of [argv, output] pairs".format(argv[1]), file=sys.stderr)
+            sys.exit(2)
+        jobs = [(job_argv, output) for job_argv, output in jobs]
+        failed = False
+        for (job_argv, _), (_, error) in zip(jobs, run_batch(jobs)):
+            if error is not None:
+                print("Error:", error, "(in: " + " ".join(job_argv) + ")", file=sys.stderr)
+                failed = True
+        if failed:
+            sys.exit(1)
+        return
+    run(argv)
+
 if __name__ == "__main__":
-    run(sys.argv[1:])
+    main(sys.argv[1:])